@@ -1,50 +1,105 @@
 """Create COCO annotations"""
 
 # Import
+import os
 from pathlib import Path
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 import json
+import struct
 from datetime import datetime
 from PIL import Image
 import numpy as np
 from skimage import measure
 from shapely.geometry import Polygon
 
+from geolabel_maker import utils
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PROGRESS_INTERVAL = 100
+# number of labels submitted ahead for each process annotating them
+PENDING_LABELS_PER_WORKER = 4
+# orjson is an optional dependency used to write the JSON file faster,
+# set to False to always use the json module
+USE_ORJSON = True
+
+
+def _relative_filenames(files, dir_path):
+    """
+        Parameters
+        ----------
+        files : list of Path
+           paths of files inside dir_path
+        dir_path : Path
+           path of the parent folder
+        Returns
+        -------
+            the list of file names relative to dir_path
+    """
+    # strip the folder prefix from the strings,
+    # rather than building a relative Path for each file
+    prefix = os.path.join(str(dir_path), "")
+    start = len(prefix)
+    filenames = []
+    for file in files:
+        filename = str(file)
+        if filename.startswith(prefix):
+            filenames.append(filename[start:])
+        else:
+            filenames.append(str(file.relative_to(dir_path)))
+
+    return filenames
+
 
 def _create_sub_masks(mask_image, colors):
     """
         Parameters
         ----------
         mask_image : PIL Image
-        colors : list of triplets
-            the list of colors used for the different categories
+            the RGB label image
+        colors : set or dict of triplets
+            the colors used for the different categories
         Returns
         -------
         a dictionary of sub-masks indexed by RGB colors
     """
-    width, height = mask_image.size
-
-    # initialize a dictionary of sub-masks indexed by RGB colors
-    sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # get the RGB values of the pixel
-            pixel = mask_image.getpixel((x, y))
-
-            # if the pixel has a color used in a category
-            if pixel in colors:
-                # check to see if we've created a sub-mask...
-                sub_mask = sub_masks.get(pixel)
-                if sub_mask is None:
-                    # create a sub-mask (one bit per pixel)
-                    # and add to the dictionary
-                    # Note: we add 1 pixel of padding in each direction
-                    # because the contours module doesn't handle cases
-                    # where pixels bleed to the edge of the image
-                    sub_masks[pixel] = Image.new("1", (width + 2, height + 2))
-
-                # set the pixel value to 1 (default is 0),
-                # accounting for padding
-                sub_masks[pixel].putpixel((x + 1, y + 1), 1)
+    pixels = np.asarray(mask_image)
+    height, width = pixels.shape[:2]
+
+    # pack the pixels' (r, g, b) values to compare them with a color at once
+    packed_pixels = utils.pack_rgb(pixels)
+
+    # create a sub-mask for each color found in the image,
+    # comparing all pixels at once instead of one pixel at a time
+    found = []
+    for color in colors:
+        is_color = packed_pixels == utils.pack_rgb(np.array(color, dtype=np.uint8))
+        if not is_color.any():
+            continue
+
+        # create a sub-mask (one boolean per pixel)
+        # Note: we add 1 pixel of padding in each direction
+        # because the contours module doesn't handle cases
+        # where pixels bleed to the edge of the image
+        sub_mask = np.zeros((height + 2, width + 2), dtype=bool)
+        sub_mask[1:-1, 1:-1] = is_color
+
+        # keep the position of the first pixel of this color,
+        # scanning the image column by column
+        first = np.argmax(is_color.T)
+        found.append((first, color, sub_mask))
+
+    # index the sub-masks by RGB colors, in the order they appear in the image
+    found.sort(key=lambda item: item[0])
+    sub_masks = {color: sub_mask for _, color, sub_mask in found}
 
     return sub_masks
 
@@ -55,7 +110,7 @@ def _create_sub_mask_annotation(
     """
             Parameters
             ----------
-            sub_mask : PIL Image
+            sub_mask : numpy 2D-array of bool
 
             image_id : int
 
@@ -74,13 +129,17 @@ def _create_sub_mask_annotation(
     # is partially occluded. (E.g. an elephant behind a tree)
     contours = measure.find_contours(sub_mask, 0.5, positive_orientation="low")
 
+    # convert the values shared by all the annotations only once
+    is_crowd = int(is_crowd)
+    image_id = int(image_id)
+    category_id = int(category_id)
+    annotation_id = int(annotation_id)
+
     annotations = []
     for contour in contours:
         # flip from (row, col) representation to (x, y)
-        # and subtract the padding pixel
-        for i in range(len(contour)):
-            row, col = contour[i]
-            contour[i] = (col - 1, row - 1)
+        # and subtract the padding pixel, for all points at once
+        contour = contour[:, ::-1] - 1
 
         # make a polygon and simplify it
         poly = Polygon(contour)
@@ -98,10 +157,10 @@ def _create_sub_mask_annotation(
 
             annotation = {
                 "segmentation": [segmentation],
-                "iscrowd": int(is_crowd),
-                "image_id": int(image_id),
-                "category_id": int(category_id),
-                "id": int(annotation_id),
+                "iscrowd": is_crowd,
+                "image_id": image_id,
+                "category_id": category_id,
+                "id": annotation_id,
                 "bbox": bbox,
                 "area": area,
             }
@@ -113,14 +172,93 @@ def _create_sub_mask_annotation(
     return last_annotation_id, annotations
 
 
-def _write_annotations(dir_label, images_ids, categories, is_crowd):
+def _create_label_annotations(file, image_id, colors_ids, is_crowd):
     """
         Parameters
         ----------
-        dir_label : str
-           path to the folder containing all label pictures
-        images_ids : list of int
-            the list of images id
+        file : Path
+           path of the label picture
+        image_id : int
+            the id of the corresponding image
+        colors_ids : dict
+            the categories' ids indexed by color as (r, g, b) triplet
+        is_crowd : bool
+            specifies whether the segmentation is for a single object (False)
+            or for a group/cluster of objects (True)
+        Returns
+        -------
+            the id following the last annotation and the label's annotations,
+            their ids are numbered from 1
+    """
+    # read label image
+    mask = Image.open(file)
+    mask = mask.convert("RGB")
+    # create sub-masks
+    sub = _create_sub_masks(mask, colors_ids)
+    # create annotations
+    annotation_id = 1
+    annotations = []
+    for color, sub_mask in sub.items():
+        # find category id
+        category_id = colors_ids[color]
+        # create a mask annotation
+        last_annotation_id, annotations_new = _create_sub_mask_annotation(
+            sub_mask, image_id, category_id, annotation_id, is_crowd
+        )
+        # save the created annotation and its id
+        annotation_id = last_annotation_id + 1
+        annotations.extend(annotations_new)
+
+    return annotation_id, annotations
+
+
+@contextmanager
+def _label_pool(max_workers=None):
+    """
+        Parameters
+        ----------
+        max_workers : int
+            number of processes used to annotate the labels.
+            Default value is None (the number of processors).
+        Yields
+        -------
+            the ProcessPoolExecutor annotating the labels and the deque
+            of its pending futures, which are cancelled on error
+    """
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        yield executor, pending
+    except BaseException:
+        # cancel the labels not started yet and don't wait for the running
+        # ones, so that the error is raised straight away
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+
+    executor.shutdown()
+
+
+def _iter_annotations(
+    executor, pending, max_pending, files, filenames, images_ids, categories, is_crowd
+):
+    """
+        Parameters
+        ----------
+        executor : ProcessPoolExecutor
+            the executor annotating the labels
+        pending : deque
+            the pending futures of the labels' annotations
+        max_pending : int
+            the maximum number of labels submitted and not yet given back,
+            which bounds the annotations held in memory
+        files : list of Path
+           paths of the label pictures
+        filenames : list of str
+           names of the label pictures, relative to their folder
+        images_ids : dict
+            the images id indexed by file name
         categories : dict
             the dictionary containing for each category,
             an unique id and a color as (r, g, b) triplet
@@ -129,99 +267,216 @@ def _write_annotations(dir_label, images_ids, categories, is_crowd):
             or for a group/cluster of objects (True)
         Returns
         -------
-            the annotations' dictionary for all labels
+            an iterator over the annotation dictionaries, label by label.
+            The first labels are annotated in the background from this call.
     """
-    # create an empty annotations' dictionary
-    annotations_dict = {"annotations": []}
+    # index the categories' ids by color
+    colors_ids = {}
+    for infos in categories.values():
+        colors_ids.setdefault(tuple(infos["color"]), infos["id"])
+
+    # get images ids
+    labels_ids = [images_ids[filename] for filename in filenames]
+
+    # annotate the labels in parallel as it is CPU bound,
+    # each label is submitted when the next future is taken
+    futures = (
+        executor.submit(_create_label_annotations, file, label_id, colors_ids, is_crowd)
+        for file, label_id in zip(files, labels_ids)
+    )
+    pending.extend(islice(futures, max_pending))
+
+    return _collect_annotations(pending, futures, len(files))
+
 
-    dir_path = Path(dir_label)
+def _collect_annotations(pending, futures, n_labels):
+    """
+        Parameters
+        ----------
+        pending : deque
+            the futures of the labels submitted, in the labels' order,
+            giving the id following the last annotation and the annotations
+        futures : iterator
+            the futures of the next labels, submitted when taken
+        n_labels : int
+            the number of labels
+        Yields
+        -------
+            the annotation dictionaries, label by label
+    """
     annotation_id = 1
-    colors = [tuple(group["color"]) for group in categories.values()]
-
-    for file in dir_path.rglob("*.png"):
-        print(file)
-        # read label image
-        mask = Image.open(file)
-        mask = mask.convert("RGB")
-        # create sub-masks
-        sub = _create_sub_masks(mask, colors)
-        # get image id
-        filename = str(file.relative_to(dir_path))
-        image_id = images_ids[filename]
-        # create annotations
-        annotations = []
-        for color, sub_mask in sub.items():
-            # find category id
-            for infos in categories.values():
-                if tuple(infos["color"]) == color:
-                    category_id = infos["id"]
-                    break
-            # create a mask annotation
-            last_annotation_id, annotations_new = _create_sub_mask_annotation(
-                sub_mask, image_id, category_id, annotation_id, is_crowd
-            )
-            # save the created annotation and its id
-            annotation_id = last_annotation_id + 1
-            annotations += annotations_new
-
-        # add these file's annotations in the final dictionary
-        annotations_dict["annotations"] += annotations
-
-    return annotations_dict
+    n = 0
+    while pending:
+        last_annotation_id, annotations = pending.popleft().result()
+        # submit the next label, to keep the same number of them in flight
+        pending.extend(islice(futures, 1))
+
+        # give back the created annotations, numbered after the previous ones
+        for annotation in annotations:
+            annotation["id"] += annotation_id - 1
+            yield annotation
+        annotation_id += last_annotation_id - 1
+
+        # report progress by batches of labels rather than for each one
+        n += 1
+        if n % PROGRESS_INTERVAL == 0 or n == n_labels:
+            print(f"{n}/{n_labels} labels processed")
+
+
+def _to_json(obj):
+    """
+        Parameters
+        ----------
+        obj : dict, list, str, int or float
+            the object to serialize
+        Returns
+        -------
+            the JSON encoded bytes of the object
+    """
+    if USE_ORJSON and orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(obj).encode()
+
+
+def _dump_json(data, f):
+    """
+        Parameters
+        ----------
+        data : dict
+            the dictionary to write, its values which are iterators
+            (like generators) are written as JSON arrays item by item,
+            so that they never have to be held in memory
+        f : file object
+            the JSON file opened in binary mode
+    """
+    f.write(b"{")
+    for i, (key, value) in enumerate(data.items()):
+        if i > 0:
+            f.write(b", ")
+        f.write(_to_json(key) + b": ")
+        if isinstance(value, Iterator):
+            f.write(b"[")
+            for j, item in enumerate(value):
+                if j > 0:
+                    f.write(b", ")
+                f.write(_to_json(item))
+            f.write(b"]")
+        else:
+            f.write(_to_json(value))
+    f.write(b"}")
 
 
 def _write_categories(categories_list):
     """
         Parameters
         ----------
-        categories_list : list of str
-           the list of category's names
+        categories_list : iterable of str
+           the category's names
         Returns
         -------
             the categories' dictionary
     """
-    # create an empty categories' dictionary
-    categories_dict = {"categories": []}
-
-    for id, category in enumerate(categories_list):
-        category_dict = {"id": id + 1, "name": category, "supercategory": category}
-        categories_dict["categories"].append(category_dict)
+    categories_dict = {
+        "categories": [
+            {"id": id, "name": category, "supercategory": category}
+            for id, category in enumerate(categories_list, 1)
+        ]
+    }
 
     return categories_dict
 
 
-def _write_images(dir_img):
+def _get_image_size(file):
+    """
+        Parameters
+        ----------
+        file : Path
+           path of the image
+        Returns
+        -------
+            the (width, height) of the image
+    """
+    # PNG tiles store their size in the IHDR chunk right after the signature,
+    # read it unbuffered to issue a single small read per file
+    fd = os.open(str(file), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        header = os.read(fd, 24)
+    finally:
+        os.close(fd)
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+        return struct.unpack(">II", header[16:24])
+
+    # other formats are read by PIL, which only parses the file header
+    with Image.open(file) as img:
+        return img.size
+
+
+def _list_tiles(dir_tiles):
+    """
+        Parameters
+        ----------
+        dir_tiles : str
+           path to a folder of tiles
+        Returns
+        -------
+            the paths of the tiles and their names relative to the folder
+    """
+    dir_path = Path(dir_tiles)
+
+    files = list(dir_path.rglob("*.png"))
+    filenames = _relative_filenames(files, dir_path)
+
+    return files, filenames
+
+
+def _list_images(dir_img):
     """
         Parameters
         ----------
         dir_img : str
            path to the folder containing all image tiles
         Returns
+        -------
+            the paths of the image tiles and their ids indexed by file name
+    """
+    files, filenames = _list_tiles(dir_img)
+
+    # save the id associated with each image
+    images_ids = {filename: img_id for img_id, filename in enumerate(filenames, 1)}
+
+    return files, images_ids
+
+
+def _write_images(files, images_ids, max_workers=None):
+    """
+        Parameters
+        ----------
+        files : list of Path
+           paths of the image tiles
+        images_ids : dict
+            the images id indexed by file name, in the same order as files
+        max_workers : int
+            number of threads used to read the images' headers.
+            Default value is None (chosen by ThreadPoolExecutor).
+        Returns
         -------
             the images' dictionary
     """
     # create an empty categories' dictionary
     images_dict = {"images": []}
-    images_ids = {}
 
-    dir_path = Path(dir_img)
-    img_id = 1
+    # get images' sizes concurrently as reading them is I/O bound
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sizes = list(executor.map(_get_image_size, files))
 
-    for file in dir_path.rglob("*.png"):
-        # get image info
-        img = Image.open(file)
-        width, height = img.size
-        filename = str(file.relative_to(dir_path))
+    for (filename, img_id), (width, height) in zip(images_ids.items(), sizes):
         # create image description
         image = {"id": img_id, "width": width, "height": height, "file_name": filename}
         # add this description in the dictionary
         images_dict["images"].append(image)
-        # save the id associated with each image
-        images_ids[filename] = img_id
-        # increment id for the next image
-        img_id += 1
 
-    return images_dict, images_ids
+    return images_dict
 
 
 def _write_info(description, zoom):
@@ -255,6 +510,7 @@ def write_complete_annotations(
     zoom,
     description="Auto-generated by Geolabel-maker",
     output_file="annotations.json",
+    max_workers=None,
 ):
     """
         Parameters
@@ -277,6 +533,9 @@ def write_complete_annotations(
         output_file : str
             name of the annotation json file which will be created.
             Default name is "annotations.json".
+        max_workers : int
+            number of processes used to annotate the labels.
+            Default value is None (the number of processors).
         Returns
         -------
             the name of the annotation json file which will be created
@@ -284,24 +543,51 @@ def write_complete_annotations(
     # make info part
     info_dict = _write_info(description, zoom)
 
-    # make images part
-    images_dict, images_ids = _write_images(dir_img)
-
-    # make annotations part
-    annotations_dict = _write_annotations(dir_label, images_ids, categories, is_crowd)
-
-    # make categories part
-    categories_dict = _write_categories(list(categories.keys()))
-
-    complete_annotations_dict = {
-        **info_dict,
-        **images_dict,
-        **annotations_dict,
-        **categories_dict,
-    }
+    # list images and labels, scanning both folders concurrently,
+    # the labels only need the images' ids to be annotated
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        labels_listing = executor.submit(_list_tiles, dir_label)
+        image_files, images_ids = _list_images(dir_img)
+        label_files, label_filenames = labels_listing.result()
+
+    with _label_pool(max_workers) as (executor, pending):
+        # make annotations part, as a stream written directly in the file,
+        # the first labels are annotated in the background from now on
+        n_workers = max_workers or os.cpu_count() or 1
+        annotations = _iter_annotations(
+            executor,
+            pending,
+            PENDING_LABELS_PER_WORKER * n_workers,
+            label_files,
+            label_filenames,
+            images_ids,
+            categories,
+            is_crowd,
+        )
+        annotations_dict = {"annotations": annotations}
+
+        # make images part, while the first labels are annotated
+        images_dict = _write_images(image_files, images_ids)
+
+        # make categories part
+        categories_dict = _write_categories(categories.keys())
+
+        complete_annotations_dict = {
+            **info_dict,
+            **images_dict,
+            **annotations_dict,
+            **categories_dict,
+        }
 
-    # write json file
-    with open(output_file, "w") as f:
-        json.dump(complete_annotations_dict, f)
+        # write json file, in a temporary file of the same folder first,
+        # so that an existing file is only replaced once everything is written
+        tmp_file = "{}.{}.tmp".format(output_file, os.getpid())
+        try:
+            with open(tmp_file, "wb") as f:
+                _dump_json(complete_annotations_dict, f)
+            os.replace(tmp_file, output_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
 
     return output_file
@@ -97,14 +97,18 @@ def make_tiles(raster_file, label_file, dir_tiles):
 
 
 @begin.subcommand
-def make_annotations(dir_tiles, config, zoom="18"):
+def make_annotations(dir_tiles, config, zoom="18", max_workers=None):
     """
     Create an annotation JSON file in the COCO format for a specific zoom level
     :param dir_tiles: Tiles directory path
     :param config: Configuration JSON file
     :param zoom: Zoom level (by default it is equal to 18)
+    :param max_workers: Number of processes used to annotate the labels
+    (by default one per processor)
     """
     print("MAKE ANNOTATIONS")
+    if max_workers is not None:
+        max_workers = int(max_workers)
     # Read groups file
     with open(config) as json_file:
         config = json.load(json_file)
@@ -118,14 +122,19 @@ def make_annotations(dir_tiles, config, zoom="18"):
     # Create the annotation JSON file
     is_crowd = False
     annotations_json = annotations.write_complete_annotations(
-        dir_imgtiles_zoom, dir_labeltiles_zoom, config, is_crowd, zoom
+        dir_imgtiles_zoom,
+        dir_labeltiles_zoom,
+        config,
+        is_crowd,
+        zoom,
+        max_workers=max_workers,
     )
 
     print(f"The file {annotations_json} contains your annotations.")
 
 
 @begin.subcommand
-def make_all(img, tiles, categories, zoom="18"):
+def make_all(img, tiles, categories, zoom="18", max_workers=None):
     """
     Run the full process to get a ground truth in the COCO format :
     1. Make label images
@@ -140,6 +149,8 @@ def make_all(img, tiles, categories, zoom="18"):
     :param tiles: Tiles directory path
     :param categories: JSON file path
     :param zoom: Zoom level (by default it is equal to 18)
+    :param max_workers: Number of processes used to annotate the labels
+    (by default one per processor)
     """
 
     # Create the label image associated to the merged raster
@@ -152,7 +163,7 @@ def make_all(img, tiles, categories, zoom="18"):
     make_tiles(images_vrt, labels_vrt, tiles)
 
     # Create the annotation file
-    make_annotations(tiles, categories, zoom)
+    make_annotations(tiles, categories, zoom, max_workers)
 
 
 @begin.start(short_args=True, lexical_order=False)
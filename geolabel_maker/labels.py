@@ -6,7 +6,7 @@ import geopandas as gpd
 import rasterio
 import rasterio.mask
 from shapely.geometry import box
-from PIL import Image, ImageChops
+from PIL import Image
 import matplotlib.pyplot as plt
 from pathlib import Path
 
@@ -15,7 +15,30 @@ from geolabel_maker import utils
 Image.MAX_IMAGE_PIXELS = 156250000
 
 
-def _select_vector(vector_file, raster_file, save=False, output_file="subset.geojson"):
+def _get_raster_extent(raster_file):
+    """
+    Read the geographic extent of a raster file from its header
+
+    Parameters
+    ----------
+    raster_file : str
+         raster file for reference
+
+    Returns
+    -------
+    the bounds and the CRS of the raster
+    """
+    with rasterio.open(raster_file) as raster_data:
+        return raster_data.bounds, raster_data.crs
+
+
+def _select_vector(
+    vector_file,
+    raster_file,
+    save=False,
+    output_file="subset.geojson",
+    raster_extent=None,
+):
     """
     Get the geometries which are in the image's extent
 
@@ -30,20 +53,24 @@ def _select_vector(vector_file, raster_file, save=False, output_file="subset.geo
     output_file : str
         output file's name
         default value is "subset.geojson"
+    raster_extent : tuple
+        the bounds and the CRS of the raster, to avoid reading them again
+        default value is None, they are then read from raster_file
 
     Returns
     -------
     the geometries of the tif file's geographic extent
     """
     # read raster file
-    raster_data = rasterio.open(raster_file)
-    coordinate = raster_data.bounds
+    if raster_extent is None:
+        raster_extent = _get_raster_extent(raster_file)
+    coordinate, crs = raster_extent
     # create a polygon from the raster bounds
     raster_bbox = box(*coordinate)
 
     # read vector file
     vector_data = gpd.read_file(vector_file)
-    vector_data = vector_data.to_crs(raster_data.crs)
+    vector_data = vector_data.to_crs(crs)
     # create a polygon from the raster bounds
     vector_bbox = box(*vector_data.total_bounds)
 
@@ -89,33 +116,24 @@ def _create_label(raster_file, categories, dir_label=""):
         out_meta = src.meta
 
         img_list = []
+        colors = []
         for name, infos in categories.items():
             out_image, out_transform = rasterio.mask.mask(
                 src, infos["geometry"], crop=False
             )
 
-            out_image = np.rollaxis(out_image, 0, 3)
-
-            # convert image in black & color
-            bw_image = utils.rgb2color(out_image, tuple(infos["color"]))
-
-            # create a PIL image
-            img = Image.fromarray(bw_image.astype(rasterio.uint8))
-
-            img_list.append(img)
+            img_list.append(np.rollaxis(out_image, 0, 3))
+            colors.append(tuple(infos["color"]))
 
-    # merge images
-    complete_img = img_list[0]
-    if len(img_list) > 1:
-        for img in img_list[1:]:
-            complete_img = ImageChops.add(complete_img, img)
+    # convert images in black & color and merge them
+    complete_img = utils.colorize_and_merge(img_list, colors)
 
     # update metadata
     out_meta.update(
         {
             "driver": "GTiff",
-            "height": complete_img.size[1],  # bw_image.shape[1],
-            "width": complete_img.size[0],  # bw_image.shape[2],
+            "height": complete_img.shape[0],
+            "width": complete_img.shape[1],
             "count": 3,
             "transform": out_transform,
         }
@@ -131,7 +149,7 @@ def _create_label(raster_file, categories, dir_label=""):
 
     # create a new raster containing labels
     with rasterio.open(output_path, "w", **out_meta) as dest:
-        dest.write(np.rollaxis(np.array(complete_img), -1, 0))
+        dest.write(np.rollaxis(complete_img, -1, 0))
 
     return output_path
 
@@ -157,8 +175,12 @@ def make_label(raster_file, categories, dir_label=""):
     -------
     name of the created label image
     """
+    # read the raster's extent once for all categories
+    raster_extent = _get_raster_extent(raster_file)
     for name, infos in categories.items():
-        infos["geometry"] = _select_vector(infos["file"], raster_file)
+        infos["geometry"] = _select_vector(
+            infos["file"], raster_file, raster_extent=raster_extent
+        )
 
     output_path = _create_label(raster_file, categories, dir_label)
 
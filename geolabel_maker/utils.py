@@ -41,14 +41,51 @@ def gray2bw(gray_img):
     return gray_img
 
 
+def pack_rgb(rgb_img):
+    """
+    Pack the (r, g, b) values of each pixel in a single integer,
+    so that a pixel can be compared to a color with one operation
+
+    Parameters
+    ----------
+    rgb_img : numpy uint8 array with shape as (..., 3)
+        image (or color) to pack
+    Returns
+    -------
+    the uint32 array with shape as (...)
+    """
+    # pad the pixels with a zero byte to view them as uint32
+    padded = np.zeros(rgb_img.shape[:-1] + (4,), dtype=np.uint8)
+    padded[..., :3] = rgb_img
+
+    return padded.view(np.uint32)[..., 0]
+
+
+def _find_non_black(rgb_img):
+    """
+    Parameters
+    ----------
+    rgb_img : numpy array with shape as (X, Y, 3)
+        image to search
+    Returns
+    -------
+    the boolean mask of the non black pixels
+    """
+    if rgb_img.dtype == np.uint8:
+        return pack_rgb(rgb_img) != 0
+
+    # other types can't be packed, check them channel by channel
+    return (rgb_img[..., 0] != 0) | (rgb_img[..., 1] != 0) | (rgb_img[..., 2] != 0)
+
+
 def rgb2color(rgb_img, color):
     """
     Convert an rgb image to a black and color image
 
     Parameters
     ----------
-    rgb_img : numpy array with shape as (3, X, Y)
-        image to convert in gray
+    rgb_img : numpy array with shape as (X, Y, 3)
+        image to convert in black and color
     color : tuple
         a color as (r, g, b) values
     Returns
@@ -58,7 +95,7 @@ def rgb2color(rgb_img, color):
     color_img = rgb_img.copy()
 
     # find non black pixels
-    mask = np.any((color_img != [0, 0, 0]), axis=-1)
+    mask = _find_non_black(rgb_img)
 
     # apply the mask to overwrite the pixels with the chosen color
     color_img[mask] = color
@@ -66,6 +103,34 @@ def rgb2color(rgb_img, color):
     return color_img
 
 
+def colorize_and_merge(rgb_imgs, colors):
+    """
+    Convert rgb images to black and color images and merge them.
+    The colors are added like PIL.ImageChops.add, the sum is clipped to 255.
+    Each image is read only once and no colored copy is made.
+
+    Parameters
+    ----------
+    rgb_imgs : list of numpy arrays with shape as (X, Y, 3)
+        images to convert in black and color
+    colors : list of tuples
+        the color as (r, g, b) values of each image
+    Returns
+    -------
+    the merged uint8 image
+    """
+    merged = np.zeros(rgb_imgs[0].shape[:2] + (3,), dtype=np.uint16)
+    for rgb_img, color in zip(rgb_imgs, colors):
+        # find non black pixels
+        mask = _find_non_black(rgb_img)
+
+        # add the chosen color to these pixels
+        merged[mask] += np.array(color, dtype=np.uint16)
+    np.clip(merged, 0, 255, out=merged)
+
+    return merged.astype(np.uint8)
+
+
 def rm_tree(pth: Path):
     """
     Remove recursively all files and folders in a directory path
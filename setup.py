@@ -49,4 +49,7 @@ setup(
         'matplotlib',
         'scikit-image',
     ],
+    extras_require={
+        'fast': ['orjson'],
+    },
 )